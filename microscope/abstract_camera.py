@@ -1,7 +1,6 @@
 """ REVISION 19-06-2015 """
 import cv2
 import numpy as np
-from scipy import ndimage
 import io
 import sys
 import time
@@ -38,10 +37,14 @@ class Camera():
         self._camera = None
         self._stream = None
         self.latest_frame = None
-        self._resolution = (width, height)
+        self._roi = (0.0, 0.0, 1.0, 1.0)  # The normalised sensor zoom region in use
+        self._flat_fields = {}  # Flat-field corrections, keyed on resolution and ROI
+        self._use_flat_field = True
+        self._frame_listeners = []  # Functions called with every frame taken
         if (((width <= 0) or (height <= 0)) and not cv2camera):
             width = self._FULL_RPI_WIDTH  # Negative dimensions use full sensor
             height = self._FULL_RPI_HEIGHT
+        self._resolution = (width, height)
         if self._usecv2:
             self._camera = cv2.VideoCapture(0)
             self._camera.set(3, width)  # Set width
@@ -122,7 +125,7 @@ class Camera():
                 self._camera.start_preview(fullscreen=False, window=(20, 20, int(640 * 1.5), int(480 * 1.5)))
                 self._view = True
 
-    def get_frame(self, greyscale=True, videoport=True, rawformat=True):
+    def get_frame(self, greyscale=True, videoport=True, rawformat=True, correct=True):
         """Manages obtaining a frame from the camera device.
 
             - Toggle greyscale to obtain either a grey frame or a BGR colour one.
@@ -132,7 +135,11 @@ class Camera():
               to array. Array is less CPU intensive.
             - If use_iterator(True) has been used to initiate the iterator method
               of capture, this method will be overriden to use that, regardless of
-              jpg/array choice."""
+              jpg/array choice.
+            - If a flat-field correction has been set for the current resolution and
+              ROI, and use_flat_field(False) has not been called, it is applied to
+              the frame in place. Set correct to False to obtain an uncorrected frame.
+            - Every frame is passed to any functions added with add_frame_listener()."""
         if self._usecv2:
             frame = self._cv2_frame(greyscale)
         elif self._fast_capture_iterator is not None:
@@ -141,9 +148,88 @@ class Camera():
             frame = self._raw_frame(greyscale, videoport)
         else:
             frame = self._jpeg_frame(greyscale, videoport)
+        if correct and self._use_flat_field and (self._flat_field_key() in self._flat_fields):
+            frame = self._correct_frame(frame)
         self.latest_frame = frame
+        for listener in self._frame_listeners:
+            listener(frame)
+        return frame
+
+    def add_frame_listener(self, listener):
+        """Call listener(frame) with every frame obtained by get_frame().
+
+            - Listeners are called in the capturing thread so must return quickly,
+              and should copy the frame if they keep it."""
+        self._frame_listeners.append(listener)
+
+    def remove_frame_listener(self, listener):
+        """Stop calling a function added with add_frame_listener()."""
+        self._frame_listeners.remove(listener)
+
+    def _flat_field_key(self):
+        """The key for the flat-field correction matching the current camera setup."""
+        return (self._resolution, self._roi)
+
+    def _correct_frame(self, frame):
+        """Apply the stored dark-frame and flat-field correction to a frame, in place
+           where possible, and return it. Use get_frame() to access."""
+        correction = self._flat_fields[self._flat_field_key()]
+        if not frame.flags.writeable:  # Some capture methods return read-only arrays
+            frame = frame.copy()
+        if frame.shape[:2] != correction["dark"].shape:
+            raise RuntimeError("Flat-field correction is %dx%d but frame is %dx%d!" % (correction["dark"].shape[::-1] + frame.shape[1::-1]))
+        if frame.shape not in correction["buffers"]:  # Allocate the working buffer once per frame shape
+            correction["buffers"][frame.shape] = np.empty(frame.shape, dtype=np.float32)
+        work = correction["buffers"][frame.shape]
+        if frame.ndim == 3:  # Colour frames use the same maps for every channel
+            dark, gain = correction["dark"][:, :, np.newaxis], correction["gain"][:, :, np.newaxis]
+        else:
+            dark, gain = correction["dark"], correction["gain"]
+        np.subtract(frame, dark, out=work)
+        np.multiply(work, gain, out=work)
+        np.clip(work, 0, 255, out=work)
+        np.rint(work, out=work)  # Round rather than truncate when converting back
+        np.copyto(frame, work, casting='unsafe')
         return frame
 
+    def average_frames(self, n=20):
+        """Capture n uncorrected greyscale frames and return their mean as a float32 array.
+
+            - Used to produce the dark and flat reference frames for set_flat_field()."""
+        total = self.get_frame(greyscale=True, correct=False).astype(np.float32)
+        for i in range(n - 1):
+            total += self.get_frame(greyscale=True, correct=False)
+        total /= n
+        return total
+
+    def set_flat_field(self, dark, flat):
+        """Set the dark-frame and flat-field correction for the current resolution and ROI.
+
+            - dark should be an averaged frame taken with no illumination, and flat an
+              averaged frame of an empty, evenly illuminated field; both greyscale.
+            - Frames are corrected as (frame - dark) * mean(flat - dark) / (flat - dark),
+              with the reciprocal gain map computed here once.
+            - Corrections for other resolutions and ROIs are kept, and used again if the
+              camera is returned to them."""
+        dark = np.array(dark, dtype=np.float32)
+        flat = np.array(flat, dtype=np.float32)
+        if dark.shape != flat.shape or dark.ndim != 2:
+            raise ValueError("Dark and flat frames must be greyscale and the same shape!")
+        if dark.shape != self._resolution[::-1]:
+            raise ValueError("Flat-field frames are %dx%d but camera resolution is %dx%d!" % (dark.shape[::-1] + self._resolution))
+        signal = np.maximum(flat - dark, 1.0)  # Avoid dividing by zero in dead pixels
+        gain = (signal.mean() / signal).astype(np.float32)
+        self._flat_fields[self._flat_field_key()] = {"dark": dark, "gain": gain, "buffers": {}}
+
+    def clear_flat_field(self):
+        """Remove the flat-field correction for the current resolution and ROI."""
+        self._flat_fields.pop(self._flat_field_key(), None)
+
+    def use_flat_field(self, enable):
+        """Turn flat-field correction of frames on or off, without removing any
+           stored corrections. Call with enable=True to turn it back on."""
+        self._use_flat_field = enable
+
     def use_iterator(self, iterator):
         """For the RPi camera only, use the capture_continuous iterator to capture
            frames many times faster.
@@ -179,9 +265,10 @@ class Camera():
             if h <= 0:
                 h = frame_h
             if not normed:
-                self._camera.zoom = (x * 1.0 / frame_w, y * 1.0 / frame_h, w * 1.0 / frame_w, h * 1.0 / frame_h)
+                self._roi = (x * 1.0 / frame_w, y * 1.0 / frame_h, w * 1.0 / frame_w, h * 1.0 / frame_h)
             else:
-                self._camera.zoom = (x, y, w, h)
+                self._roi = (x, y, w, h)
+            self._camera.zoom = self._roi
 
     def find_template(self, template, frame=None, bead_pos=(-1,-1), boxD=100, centremass=True,
                       crosscorr=True, fraction=0.05, decimal=False):
@@ -230,6 +317,7 @@ class Camera():
         corr += (corr.max() - corr.min()) * fraction - corr.max()
         corr = cv2.threshold(corr, 0, 0, cv2.THRESH_TOZERO)[1]
         if centremass:  # Either centre of mass:
+            from scipy import ndimage  # Imported here since scipy is slow to import
             peak = ndimage.measurements.center_of_mass(corr)
             # Array indexing means peak has (y,x) not (x,y):
             centre = (peak[1] + temp_w / 2.0, peak[0] + temp_h / 2.0)
@@ -13,23 +13,29 @@ class Stage():
     _XYZ_BOUND = np.array([5000, 5000, 5000])
     _MICROSTEPS = 16  # How many microsteps per step
 
-    def __init__(self, tty="/dev/ttyACM0"):
+    def __init__(self, tty="/dev/ttyACM0", timeout=10):
         """Class representing a 3-axis microscope stage.
 
             If the serial device is not found, it will be emulated by default(!)
-            and a warning message printed."""
+            and a warning message printed. If the device is found but does not send
+            its start-up line within timeout seconds, a RuntimeError is raised."""
         self._emulate = False
         self._pos = np.array([0, 0, 0])
         try:  # Attempt to open the stage:
-            self._ser = serial.Serial(tty)
+            self._ser = serial.Serial(tty, timeout=timeout)
         except serial.serialutil.SerialException:
             print "Emulating Stage!"
             self._emulate = True  # If it fails, emulate a stage
-        if self._emulate:
-            self.ver = "Emulated Stage"
-        else:  # When the Arduino is connected, it sends code version details to say it is ready:
+        if not self._emulate:  # When the Arduino is connected, it sends code version details to say it is ready:
             self.ver = self._ser.readline()  # When opening, read in the start-up line
             self.ver = self.ver.replace("\r\n", "")  # Remove extra characters and store
+            if self.ver == "":  # The readline timed out
+                self._ser.close()
+                self._emulate = True  # So that deletion does not try to use the closed port
+                raise RuntimeError("Stage on %s did not respond within %ds!" % (tty, timeout))
+            self._ser.timeout = None  # Moves may take any length of time to complete
+        if self._emulate:
+            self.ver = "Emulated Stage"
 
     def _close(self):
         """Close serial comms, turn off motors if necessary."""
@@ -0,0 +1,56 @@
+# Times template-free particle detection and linking on synthetic frames, so
+# no camera is needed. Run from the command-line, optionally giving the number
+# of particles, the number of frames and the frame width and height:
+#     python benchmark_particles.py [particles] [frames] [width] [height]
+import sys
+import time
+import numpy as np
+import particle_tracking
+
+
+def synthetic_frames(n_particles=300, n_frames=100, width=640, height=480, diameter=9, step=1.0):
+    """Return a list of greyscale frames of Gaussian particles, each moving a random
+       step of about step pixels between frames, on a noisy background."""
+    rand = np.random.RandomState(0)
+    positions = rand.uniform(diameter, [width - diameter, height - diameter], (n_particles, 2))
+    y, x = np.mgrid[-diameter:diameter + 1, -diameter:diameter + 1]
+    frames = []
+    for n in range(n_frames):
+        frame = rand.normal(20, 3, (height, width))
+        for px, py in positions:
+            ix, iy = int(px), int(py)
+            spot = 150 * np.exp(-((x - (px - ix)) ** 2 + (y - (py - iy)) ** 2) / (2 * (diameter / 4.0) ** 2))
+            y1, x1 = max(iy - diameter, 0), max(ix - diameter, 0)
+            y2, x2 = min(iy + diameter + 1, height), min(ix + diameter + 1, width)
+            frame[y1:y2, x1:x2] += spot[y1 - iy + diameter:y2 - iy + diameter, x1 - ix + diameter:x2 - ix + diameter]
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+        positions = np.clip(positions + rand.normal(0, step, positions.shape), diameter, [width - diameter, height - diameter])
+    return frames
+
+
+def benchmark_particles(frames, diameter=9, min_mass=100, search_range=10):
+    """Detect and link the particles in every frame, returning a dictionary of the mean
+       time in seconds per frame for detection and for linking, and the mean number
+       of particles found per frame."""
+    linker = particle_tracking.ParticleLinker(search_range)
+    detect_time, link_time, found = 0.0, 0.0, 0
+    for frame in frames:
+        start = time.time()
+        positions, masses = particle_tracking.find_particles(frame, diameter, min_mass)
+        detect_time += time.time() - start
+        start = time.time()
+        linker.link(positions, masses)
+        link_time += time.time() - start
+        found += len(positions)
+    n = float(len(frames))
+    return {"detect": detect_time / n, "link": link_time / n, "particles": found / n}
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:5]]
+    frames = synthetic_frames(*args)
+    times = benchmark_particles(frames)
+    total = times["detect"] + times["link"]
+    print "particles per frame:  %.1f" % times["particles"]
+    print "detect:               %.2fms" % (times["detect"] * 1000)
+    print "link:                 %.2fms" % (times["link"] * 1000)
+    print "total:                %.2fms (%.1f frames/s)" % (total * 1000, 1.0 / total)
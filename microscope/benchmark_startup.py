@@ -0,0 +1,35 @@
+# Times how long the microscope takes to start: importing the code, creating
+# the Microscope object, taking the first frame and having every device ready.
+# Run from the command-line, optionally giving the serial port of the stage:
+#     python benchmark_startup.py [tty]
+import sys
+import time
+
+start = time.time()
+import microscope_3d
+import_time = time.time() - start
+
+
+def benchmark_startup(tty="/dev/ttyACM0", cv2camera=False):
+    """Create a Microscope and return a dictionary of the times in seconds taken to
+       create it, take the first frame and finish starting every device."""
+    times = {}
+    start = time.time()
+    m = microscope_3d.Microscope(cv2camera=cv2camera, tty=tty)
+    times["create"] = time.time() - start
+    m.camera.get_frame()
+    times["first_frame"] = time.time() - start
+    m.wait_until_ready()
+    times["ready"] = time.time() - start
+    del m
+    return times
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        times = benchmark_startup(tty=sys.argv[1])
+    else:
+        times = benchmark_startup()
+    print "import:       %.3fs" % import_time
+    print "create:       %.3fs" % times["create"]
+    print "first frame:  %.3fs" % times["first_frame"]
+    print "ready:        %.3fs" % times["ready"]
@@ -1,6 +1,6 @@
 """ REVISION 19-06-2015 """
-import h5py
 import datetime
+import time
 import numpy as np
 
 
@@ -29,7 +29,12 @@ class Datafile():
             self._filename = self._DEFAULT_FILE + "_" + self._date + ".hdf5"
             self._datafile = None  # Don't make one just yet
         else:
-            self._datafile = h5py.File(filename, 'a')
+            self._datafile = self._open(filename)
+
+    def _open(self, filename):
+        """Open the hdf5 file; h5py is only imported here since it is slow to import."""
+        import h5py
+        return h5py.File(filename, 'a')
 
     def _close(self):
         """Close the file object and clean up. Called on deletion, do not call explicitly."""
@@ -49,7 +54,7 @@ class Datafile():
             correctly.
           - (May overflow after 999 groups of same name.)"""
         if self._datafile is None:  # If weren't asked for datafile, but do need one:
-            self._datafile = h5py.File(self._filename, 'a')  # Make one using the filename generated
+            self._datafile = self._open(self._filename)  # Make one using the filename generated
         keys = self._datafile.keys()
         n = 0
         while group + "%03d" % n in keys:
@@ -80,3 +85,37 @@ class Datafile():
         if description is not None:
             dset.attrs.create("Description", description)
         self._datafile.flush()
+
+    def append_data(self, indata, group_object, dataset, description=None, extend=False):
+        """Given a datafile group object, append an array to an extendable dataset in it.
+
+          - indata should be a array-like object; every array appended to the same
+            dataset must have the same shape.
+          - Unlike add_data(...), the dataset name is used as given: the first call
+            creates it and later calls add a new entry along its first axis, so
+            repeated frames do not create a new dataset each time.
+          - Set extend to True to append each entry along the first axis of indata
+            instead, such as the rows of a table; all then share one timestamp.
+          - A time.time() timestamp for each entry is stored in a dataset with
+            "_timestamps" appended to the name."""
+        indata = np.array(indata)
+        if not extend:
+            indata = indata[np.newaxis]
+        if dataset not in group_object.keys():
+            entry_shape = indata.shape[1:]
+            chunk_rows = 1 if not extend else max(1, 4096 // max(1, int(np.prod(entry_shape))))
+            dset = group_object.create_dataset(dataset, shape=(0,) + entry_shape, maxshape=(None,) + entry_shape,
+                                               dtype=indata.dtype, chunks=(chunk_rows,) + entry_shape)
+            dset.attrs.create("timestamp", datetime.datetime.now().isoformat())  # Add a timestamp attribute
+            if description is not None:
+                dset.attrs.create("Description", description)
+            tset = group_object.create_dataset(dataset + "_timestamps", shape=(0,), maxshape=(None,), dtype=np.float64)
+        else:
+            dset = group_object[dataset]
+            tset = group_object[dataset + "_timestamps"]
+        n, rows = dset.shape[0], indata.shape[0]
+        dset.resize(n + rows, axis=0)
+        dset[n:n + rows] = indata
+        tset.resize(n + rows, axis=0)
+        tset[n:n + rows] = time.time()
+        self._datafile.flush()
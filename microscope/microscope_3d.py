@@ -1,10 +1,12 @@
 """ REVISION 19-06-2015 """
-# The microscope may be slow to be created; it must wait for the camera, stage
-# and the datafile to be ready for use.
+# The camera and stage are started in parallel in the background, so creating
+# the microscope returns quickly; use ready() or wait_until_ready() to check on them.
 import numpy as np
 import cv2
 import datetime
+import sys
 import time
+import threading
 import abstract_camera
 import arduino_stage
 import data_file
@@ -30,20 +32,36 @@ class Microscope():
     _GUI_KEY_ENTER = 13
     # Other useful constants:
     _ARROW_STEP_SIZE = 32
+    # The longest time in seconds to wait for a device to start:
+    _DEVICE_TIMEOUT = 30
+    # Moves longer than this (in microsteps, on any axis) are made mostly in whole steps:
+    _FAST_MOVE_MIN = 256
     # Spatial conversions from pixels to microns. This needs to be updated by hand.
     _UM_PER_PIXEL = 0.4846
     # Store a conversion matrix, can be updated with result of calibrate() if necessary.
     _CAMERA_TO_STAGE_MATRIX = np.array([[5.2, 7.0], [6.3, -5.6]])
 
-    def __init__(self, width=640, height=480, cv2camera=False, tty="/dev/ttyACM0", filename=None):
+    def __init__(self, width=640, height=480, cv2camera=False, tty="/dev/ttyACM0", filename=None, stage_timeout=10):
         """Creates a new Microscope containing a Camera and Stage object.
 
             - Optionally specify a width and height for Camera object,
               the serial port for the Stage object and a filename for the
-              attached datafile."""
-        # Internal objects needed:
-        self.camera = abstract_camera.Camera(width, height, cv2camera)
-        self.stage = arduino_stage.Stage(tty)
+              attached datafile.
+            - The Camera and Stage are created in parallel background threads;
+              accessing Microscope.camera or Microscope.stage waits for that
+              device only, for at most _DEVICE_TIMEOUT seconds.
+            - stage_timeout is how many seconds to wait for the Arduino to send
+              its start-up line; if it does not, accessing Microscope.stage
+              raises a RuntimeError."""
+        # Internal objects needed, the devices are started in the background:
+        self._devices = {}
+        self._device_errors = {}
+        self._device_threads = {
+            "camera": threading.Thread(target=self._start_device, args=("camera", abstract_camera.Camera, (width, height, cv2camera))),
+            "stage": threading.Thread(target=self._start_device, args=("stage", arduino_stage.Stage, (tty, stage_timeout)))}
+        for thread in self._device_threads.values():
+            thread.daemon = True
+            thread.start()
         self.datafile = data_file.Datafile(filename)
         # Set up the GUI variables:
         self._gui_quit = False
@@ -61,10 +79,60 @@ class Microscope():
     def __del__(self):
         # Close the attached objects properly by deleting them
         cv2.destroyAllWindows()
-        del self.camera
-        del self.stage
+        self.wait_until_ready(self._DEVICE_TIMEOUT)
+        del self._devices
         del self.datafile
 
+    def _start_device(self, name, device_class, args):
+        """Create a device object, storing it or any exception raised. Run in a thread."""
+        try:
+            self._devices[name] = device_class(*args)
+        except Exception:
+            self._device_errors[name] = sys.exc_info()
+
+    def _device(self, name):
+        """Wait for a device to be started and return it, re-raising any exception
+           raised while starting it. Raises RuntimeError if it takes too long."""
+        self._device_threads[name].join(self._DEVICE_TIMEOUT)
+        if self._device_threads[name].is_alive():
+            raise RuntimeError("The %s did not start within %ds!" % (name, self._DEVICE_TIMEOUT))
+        if name in self._device_errors:
+            exc_type, exc_value, exc_traceback = self._device_errors[name]
+            raise exc_type, exc_value, exc_traceback
+        return self._devices[name]
+
+    @property
+    def camera(self):
+        """The Camera object; waits for the camera to be started if necessary."""
+        return self._device("camera")
+
+    @property
+    def stage(self):
+        """The Stage object; waits for the stage to be started if necessary."""
+        return self._device("stage")
+
+    def ready(self, device=None):
+        """Returns True if the devices have finished starting, without waiting.
+
+            - Specify device as "camera" or "stage" to check only that device.
+            - A device which failed to start counts as ready; accessing it will
+              raise the error."""
+        if device is not None:
+            return not self._device_threads[device].is_alive()
+        return not any(thread.is_alive() for thread in self._device_threads.values())
+
+    def wait_until_ready(self, timeout=None):
+        """Wait for the camera and stage to finish starting; returns ready().
+
+            - If timeout is specified, wait at most this many seconds in total."""
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._device_threads.values():
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - time.time(), 0))
+        return self.ready()
+
     def _gui_nothing(self, x):
         """GUI needs callbacks for some functions: this is a blank one."""
         pass
@@ -307,6 +375,184 @@ class Microscope():
         self.camera._preview()
         return A
 
+    def calibrate_flat_field(self, dark, flat):
+        """Store dark and flat reference frames in the datafile and use them to correct
+           all frames taken at the current camera resolution and ROI. Returns the
+           datafile group the reference frames were stored in.
+
+            - dark and flat should be made with camera.average_frames(): dark with
+              the illumination blocked, and flat with it restored and an empty region
+              of the slide in view. Prompting the user between the two is left to the
+              calling script."""
+        self.camera.set_flat_field(dark, flat)  # Check the frames before storing them
+        group = self.datafile.new_group("flat_field", description="Averaged dark and flat reference frames")
+        group.attrs.create("resolution", self.camera._resolution)
+        group.attrs.create("roi", self.camera._roi)
+        self.datafile.add_data(dark, group, "dark", description="Averaged frame with no illumination")
+        self.datafile.add_data(flat, group, "flat", description="Averaged frame of an empty field")
+        return group
+
+    def load_flat_field(self, group):
+        """Use the reference frames stored in a datafile group by calibrate_flat_field()
+           to correct frames taken at the current camera resolution and ROI.
+
+            - Raises ValueError if the group was calibrated at a different resolution
+              or ROI to the one the camera is currently using."""
+        resolution, roi = tuple(group.attrs["resolution"]), tuple(group.attrs["roi"])
+        if resolution != self.camera._resolution or not np.allclose(roi, self.camera._roi):
+            raise ValueError("Flat-field was calibrated at resolution %s and ROI %s, but camera is at %s and %s!"
+                             % (resolution, roi, self.camera._resolution, self.camera._roi))
+        self.camera.set_flat_field(group["dark00000"][...], group["flat00000"][...])
+
+    def track_particles(self, n_frames, diameter=9, min_mass=100, invert=False, search_range=10, memory=0):
+        """Find and follow every particle in the field of view without a template, for
+           n_frames frames. Returns the datafile group the trajectories are stored in.
+
+            - diameter, min_mass and invert are passed to particle_tracking.find_particles(),
+              and search_range and memory to particle_tracking.ParticleLinker.
+            - The trajectories are appended to the "trajectories" dataset of the group
+              in batches as they are found, as rows of (frame, id, x, y, mass, time),
+              where time is when the frame was taken. Rows already found are saved
+              even if tracking fails part way through."""
+        import particle_tracking  # Imported here to keep start-up fast
+        group = self.datafile.new_group("particles", description="Template-free particle trajectories")
+        group.attrs.create("diameter", diameter)
+        group.attrs.create("search_range", search_range)
+        linker = particle_tracking.ParticleLinker(search_range, memory, self.datafile, group)
+        try:
+            for n in range(n_frames):
+                frame = self.camera.get_frame(greyscale=True)
+                frame_time = time.time()
+                positions, masses = particle_tracking.find_particles(frame, diameter, min_mass, invert)
+                linker.link(positions, masses, frame_time)
+        finally:
+            linker.flush()
+        return group
+
+    def start_stream_server(self, port=8080, capture=False, **kwargs):
+        """Start streaming camera frames over HTTP on the local network; returns the
+           StreamServer, whose stop() method ends streaming.
+
+            - View http://<address>:<port>/ in a browser to watch the preview stream.
+            - Set capture to True to take frames continuously when the GUI is not
+              running; otherwise only the frames other code takes are streamed.
+            - Other keyword arguments are passed to StreamServer."""
+        import stream_server  # Imported here so scripts not streaming don't load the HTTP modules
+        server = stream_server.StreamServer(self, port, **kwargs)
+        server.start(capture)
+        return server
+
+    def _travel_to(self, position, release=False):
+        """Move the stage to an absolute position. Long hops are made in whole steps
+           using fast_move, with move_rel making the final approach in microsteps."""
+        move = np.subtract(position, self.stage._pos)
+        if np.max(np.absolute(move)) > self._FAST_MOVE_MIN:
+            steps = self.stage._MICROSTEPS
+            whole_steps = np.fix(move / float(steps)).astype(int) * steps  # Round towards zero
+            self.stage.fast_move(whole_steps, release=False)
+        self.stage.move_to_pos(position, release=release)
+
+    def _timelapse_route(self, sites):
+        """Order the time-lapse sites to reduce stage travel, starting from the current
+           stage position and greedily visiting the nearest remaining site."""
+        route = []
+        remaining = list(sites)
+        current = self.stage._pos
+        while remaining:
+            distances = [np.sum(np.absolute(np.subtract(site["position"], current))) for site in remaining]
+            site = remaining.pop(int(np.argmin(distances)))
+            route.append(site)
+            current = site["position"]
+        return route
+
+    def _timelapse_save(self, frame, position, group, errors):
+        """Append a time-lapse frame and the stage position it was taken at to a group.
+           Run in a thread; any exception raised is added to errors."""
+        try:
+            self.datafile.append_data(frame, group, "frames")
+            self.datafile.append_data(position, group, "positions")
+        except Exception:
+            errors.append(sys.exc_info())
+
+    def _timelapse_join(self, saving, errors):
+        """Wait for a time-lapse frame to be saved, re-raising any error saving it."""
+        saving.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors.pop()
+            raise exc_type, exc_value, exc_traceback
+
+    def timelapse(self, positions, interval, rounds, settle=0.5, greyscale=True):
+        """Visit a list of named stage positions every interval seconds, saving a frame at
+           each. Returns a tuple (groups, missed) where groups is a dictionary mapping
+           position names to their datafile groups and missed is a list of the rounds
+           which overran the interval.
+
+            - positions should be a list of tuples (name, position), where position is
+              the [x,y,z] stage position in microsteps. A template image and a focus
+              offset in microsteps can optionally be added as (name, position, template,
+              focus_offset); the template is re-centred on at every visit, and the
+              stored position updated to follow any drift.
+            - rounds is the number of times every position is visited.
+            - Each round is ordered to minimise stage travel, and the frame from one
+              position is saved while the stage is travelling to the next.
+            - settle is the time in seconds to wait after a move before capturing.
+            - Each time-lapse has its own datafile group, containing a group for each
+              position named after it, with the frames and the stage positions appended
+              to "frames" and "positions" datasets.
+            - The motors are released after each round, between visits."""
+        sites = []
+        groups = {}
+        run = self.datafile.new_group("timelapse", description="Multi-position time-lapse")
+        run.attrs.create("interval", interval)
+        for p in positions:
+            name, position = p[0], np.array(p[1])
+            assert position.shape == (3, ), "timelapse positions must have 3 component vectors."
+            template = p[2] if len(p) > 2 else None
+            focus_offset = p[3] if len(p) > 3 else 0
+            if template is not None and len(template.shape) == 3:
+                template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+            assert name not in groups, "timelapse position names must be unique."
+            sites.append({"name": name, "position": position, "template": template, "focus_offset": focus_offset})
+            groups[name] = run.create_group(name)
+            groups[name].attrs.create("name", name)
+            groups[name].attrs.create("position", position)
+            groups[name].attrs.create("focus_offset", focus_offset)
+        missed = []
+        errors = []
+        saving = None
+        start_time = time.time()
+        try:
+            for n in range(rounds):
+                wait = start_time + n * interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                for site in self._timelapse_route(sites):
+                    self._travel_to(site["position"], release=False)
+                    time.sleep(settle)
+                    if saving is not None:  # The previous frame must be saved before the camera is used again
+                        self._timelapse_join(saving, errors)
+                    if site["template"] is not None:
+                        self.centre_on_template(site["template"], release=False)
+                        site["position"] = self.stage._pos.copy()
+                    if site["focus_offset"] != 0:
+                        self.stage.focus_rel(site["focus_offset"], release=False)
+                        time.sleep(settle)
+                    frame = self.camera.get_frame(greyscale=greyscale)
+                    saving = threading.Thread(target=self._timelapse_save,
+                                              args=(frame, self.stage._pos.copy(), groups[site["name"]], errors))
+                    saving.start()
+                self.stage.release()  # Don't leave the motors heating the stage between rounds
+                if time.time() > start_time + (n + 1) * interval:
+                    print "Round %d of timelapse took longer than the %.1fs interval" % (n, interval)
+                    missed.append(n)
+        finally:  # Even if something fails, finish saving and turn the motors off
+            if saving is not None:
+                saving.join()
+            self.stage.release()
+        if saving is not None:
+            self._timelapse_join(saving, errors)
+        return (groups, missed)
+
 if __name__ == "__main__":
     m = Microscope()
     m.run_gui()
@@ -0,0 +1,155 @@
+# Template-free detection of many particles in a frame, and linking of the
+# detections in successive frames into trajectories. Unlike find_template in the
+# Camera class, every particle in the frame is found in one vectorised pass.
+import time
+import cv2
+import numpy as np
+
+
+def find_particles(frame, diameter=9, min_mass=100, invert=False, noise_size=1):
+    """Find every bright, roughly circular particle in a frame. Returns a tuple
+       (positions, masses), where positions is an Nx2 array of sub-pixel camera
+       coordinates (x,y) and masses the summed filtered brightness of each particle.
+
+        - diameter is the approximate particle size in pixels, and must be odd. It
+          sets the minimum separation of particles and the size of the window used
+          to find each centroid; the background is averaged over twice this size.
+        - Particles with a mass less than min_mass are discarded as noise.
+        - Set invert to True to find dark particles on a bright background.
+        - noise_size is the width in pixels of the Gaussian used to smooth out
+          pixel noise.
+        - Particles too close to the edge of the frame for a full window are ignored."""
+    if diameter % 2 == 0:
+        raise ValueError("Particle diameter must be odd, not %d!" % diameter)
+    if len(frame.shape) == 3:  # If the frame is a colour image (3 channels), make greyscale
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    image = frame.astype(np.float32)
+    if invert:
+        np.subtract(255, image, out=image)
+    radius = diameter // 2
+    # Band-pass: smooth out pixel noise, then subtract the local background. The
+    # background window must be larger than a particle, or it removes the particle too.
+    filtered = cv2.GaussianBlur(image, (0, 0), noise_size)
+    filtered -= cv2.blur(image, (2 * diameter + 1, 2 * diameter + 1))
+    np.maximum(filtered, 0, out=filtered)
+    # Local maxima are the pixels equal to the maximum of their neighbourhood
+    dilated = cv2.dilate(filtered, np.ones((diameter, diameter), np.uint8))
+    ys, xs = np.nonzero((filtered == dilated) & (filtered > 0))
+    h, w = filtered.shape
+    inside = (xs >= radius) & (xs < w - radius) & (ys >= radius) & (ys < h - radius)
+    xs, ys = xs[inside], ys[inside]
+    if len(xs) > 1:  # Equal or nearby maxima must not be reported as separate particles
+        xs, ys = _separate_maxima(xs, ys, filtered[ys, xs], diameter)
+    # Centroid within a window around every maximum at once; windows is N x diameter x diameter
+    offsets = np.arange(-radius, radius + 1)
+    windows = filtered[ys[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis],
+                       xs[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]]
+    masses = windows.sum(axis=(1, 2))
+    bright = masses >= min_mass
+    windows, masses, xs, ys = windows[bright], masses[bright], xs[bright], ys[bright]
+    x = xs + np.dot(windows.sum(axis=1), offsets) / masses
+    y = ys + np.dot(windows.sum(axis=2), offsets) / masses
+    return (np.column_stack((x, y)), masses)
+
+
+def _separate_maxima(xs, ys, peaks, separation):
+    """Drop every maximum within separation pixels of a brighter one, keeping the
+       first of equally bright maxima. Returns the remaining (xs, ys)."""
+    from scipy.spatial import cKDTree  # Imported here since scipy is slow to import
+    pairs = np.array(list(cKDTree(np.column_stack((xs, ys))).query_pairs(separation)), dtype=int).reshape(-1, 2)
+    rank = np.empty(len(xs), dtype=int)  # 0 for the brightest maximum
+    rank[np.lexsort((np.arange(len(xs)), -peaks))] = np.arange(len(xs))
+    dimmer = np.where(rank[pairs[:, 0]] > rank[pairs[:, 1]], pairs[:, 0], pairs[:, 1])
+    keep = np.ones(len(xs), dtype=bool)
+    keep[dimmer] = False
+    return (xs[keep], ys[keep])
+
+
+class ParticleLinker():
+    """Link particles found in successive frames into trajectories.
+
+       Each call to link() takes the particle positions in the next frame and
+       returns a trajectory id for each. Particles are matched to the nearest
+       unclaimed particle from earlier frames, found with a k-d tree rather than
+       comparing every pair. Trajectories can be written to a datafile group as
+       they are linked; call flush() when finished to write any still buffered."""
+    _CANDIDATES = 3  # How many nearby earlier particles to consider for each particle
+
+    def __init__(self, search_range=10, memory=0, datafile=None, group_object=None, save_every=50):
+        """Create a linker for a new set of trajectories.
+
+            - search_range is the furthest in pixels a particle may move between
+              frames and still be linked.
+            - memory is how many frames a particle may go missing for and still
+              be linked when it reappears.
+            - If a Datafile and one of its group objects are given, a row of
+              (frame, id, x, y, mass, time) is appended to its "trajectories"
+              dataset for every particle linked, where time is when the frame
+              was taken.
+            - Rows are buffered and written every save_every frames, to avoid writing
+              to the datafile on every frame. The "trajectories_timestamps" dataset
+              therefore records when rows were written, not when frames were taken."""
+        self._search_range = search_range
+        self._memory = memory
+        self._datafile = datafile
+        self._group = group_object
+        self._save_every = save_every
+        self._rows = []  # Trajectory rows not yet written to the datafile
+        self._frame = 0
+        self._next_id = 0
+        self._ids = np.zeros(0, dtype=int)  # The particles which can still be linked to
+        self._positions = np.zeros((0, 2))
+        self._last_seen = np.zeros(0, dtype=int)
+
+    def link(self, positions, masses=None, frame_time=None):
+        """Link the particle positions from the next frame, returning their ids.
+
+            - positions should be an Nx2 array of (x,y) positions, as returned by
+              find_particles(); masses are only used when saving to the datafile.
+            - frame_time is the time.time() the frame was taken, saved with each
+              row; if not given, the current time is used.
+            - Particles that cannot be linked start new trajectories."""
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        ids = np.empty(len(positions), dtype=int)
+        ids.fill(-1)
+        claimed = np.zeros(len(self._ids), dtype=bool)
+        if len(positions) > 0 and len(self._ids) > 0:
+            from scipy.spatial import cKDTree  # Imported here since scipy is slow to import
+            k = min(self._CANDIDATES, len(self._ids))
+            distances, indices = cKDTree(self._positions).query(positions, k=k, distance_upper_bound=self._search_range)
+            distances, indices = distances.reshape(-1, k), indices.reshape(-1, k)
+            new_index = np.repeat(np.arange(len(positions)), k)
+            distances, indices = distances.ravel(), indices.ravel()
+            valid = np.isfinite(distances)  # Candidates out of range have infinite distance
+            order = np.argsort(distances[valid])
+            # Greedily accept the closest pairs first, each particle used only once:
+            for i, j in zip(new_index[valid][order], indices[valid][order]):
+                if ids[i] < 0 and not claimed[j]:
+                    ids[i] = self._ids[j]
+                    claimed[j] = True
+        unlinked = ids < 0
+        ids[unlinked] = np.arange(self._next_id, self._next_id + np.count_nonzero(unlinked))
+        self._next_id += np.count_nonzero(unlinked)
+        # Keep the particles not found in this frame if they are within memory:
+        remembered = ~claimed & (self._frame - self._last_seen <= self._memory)
+        self._ids = np.concatenate((ids, self._ids[remembered]))
+        self._positions = np.concatenate((positions, self._positions[remembered]))
+        self._last_seen = np.concatenate((np.repeat(self._frame, len(ids)), self._last_seen[remembered]))
+        if self._group is not None and len(ids) > 0:
+            if masses is None:
+                masses = np.zeros(len(ids))
+            if frame_time is None:
+                frame_time = time.time()
+            self._rows.append(np.column_stack((np.repeat(self._frame, len(ids)), ids, positions, masses,
+                                               np.repeat(frame_time, len(ids)))))
+        self._frame += 1
+        if self._frame % self._save_every == 0:
+            self.flush()
+        return ids
+
+    def flush(self):
+        """Write any buffered trajectory rows to the datafile."""
+        if self._group is not None and self._rows:
+            rows = np.concatenate(self._rows)
+            self._rows = []
+            self._datafile.append_data(rows, self._group, "trajectories", description="frame, id, x, y, mass, time", extend=True)
@@ -0,0 +1,292 @@
+# Serves the microscope camera over HTTP so it can be watched from other
+# computers on the local network. Each frame is encoded once, however many
+# viewers are connected.
+import BaseHTTPServer
+import SocketServer
+import json
+import socket
+import threading
+import time
+import cv2
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server handling each client in its own thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle a single HTTP request to the StreamServer."""
+    _BOUNDARY = "frame"
+
+    def do_GET(self):
+        stream = self.server.stream
+        path = self.path.split("?")[0]
+        if path == "/stream.mjpg":
+            self._send_mjpeg(stream, preview=False)
+        elif path == "/preview.mjpg":
+            self._send_mjpeg(stream, preview=True)
+        elif path == "/frame.jpg":
+            jpeg = stream.snapshot()
+            if jpeg is None:
+                self.send_error(503, "No frame has been taken yet")
+            else:
+                self._send_content(jpeg, "image/jpeg")
+        elif path == "/status.json":
+            self._send_content(json.dumps(stream.status()), "application/json")
+        elif path == "/":
+            self._send_content(stream._INDEX_PAGE, "text/html")
+        else:
+            self.send_error(404)
+
+    def _send_content(self, content, content_type):
+        """Send a complete response with the given body."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_mjpeg(self, stream, preview):
+        """Send frames as a multipart MJPEG stream until the client disconnects.
+           A slow client simply skips to the latest frame each time."""
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=%s" % self._BOUNDARY)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        stream._add_client(preview)
+        try:
+            number = -1
+            while True:
+                number, jpeg = stream._wait_for_frame(number, preview)
+                if jpeg is None:  # The server is stopping
+                    break
+                self.wfile.write("--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % (self._BOUNDARY, len(jpeg)))
+                self.wfile.write(jpeg)
+                self.wfile.write("\r\n")
+        except socket.error:  # The client has disconnected
+            pass
+        finally:
+            stream._remove_client(preview)
+
+    def log_message(self, format, *args):
+        """Don't print a line for every request."""
+        pass
+
+
+class StreamServer():
+    """Stream frames from the microscope camera over HTTP on the local network.
+
+       Frames taken by the camera, by the GUI or any other code, are JPEG encoded
+       once in a background thread and sent to every connected viewer. The
+       following paths are served:
+        - /stream.mjpg: an MJPEG stream of full size frames.
+        - /preview.mjpg: an MJPEG stream of downscaled frames.
+        - /frame.jpg: the latest frame as a single JPEG image.
+        - /status.json: the stage position and tracker state.
+        - /: a page showing the preview stream."""
+    _SNAPSHOT_TIMEOUT = 2  # Seconds /frame.jpg waits for a new frame when capturing
+    _INDEX_PAGE = "<html><head><title>Microscope</title></head><body><img src=\"/preview.mjpg\"></body></html>"
+
+    def __init__(self, microscope, port=8080, host="", quality=80, preview_scale=0.5, max_fps=15):
+        """Create a server for a Microscope object, listening on the given port.
+
+            - host can be set to "localhost" to only allow viewers on this computer.
+              A port of 0 picks any free port; the port used is stored in self.port.
+            - quality is the JPEG quality (0 to 100) of the encoded frames.
+            - preview_scale is the size of the preview frames relative to the
+              full frames.
+            - At most max_fps frames per second are encoded. If frames arrive
+              faster, or the encoding is too slow, older frames are skipped.
+            - Call start() to begin serving, and stop() to finish. stop() must be
+              called to close the port; the server cannot be started again after."""
+        self._microscope = microscope
+        self._quality = quality
+        self._preview_scale = preview_scale
+        self._min_interval = 1.0 / max_fps
+        self._condition = threading.Condition()
+        self._running = False
+        self._capture = False
+        self._closed = False
+        self._snapshot_pending = False  # A /frame.jpg request is waiting for the capture thread
+        self._new_frame = None  # The latest frame not yet encoded
+        self._latest_frame = None  # The last frame encoded, kept for snapshot()
+        self._last_copy = 0  # When _on_frame() last kept a frame
+        self._snapshot = (None, None)  # The frame number and JPEG of the last snapshot() encoding
+        self._snapshot_lock = threading.Lock()
+        self._frame_number = 0
+        self._frame_time = None
+        self._jpegs = {False: None, True: None}  # Full and preview encodings of the latest frame
+        self._clients = {False: 0, True: 0}
+        self._threads = []
+        self._server = _ThreadedHTTPServer((host, port), _StreamHandler)
+        self._server.stream = self
+        self.port = self._server.server_address[1]
+
+    def start(self, capture=False):
+        """Start serving in background threads.
+
+            - By default only frames taken by other code (such as the GUI) are
+              streamed. Set capture to True to also take frames continuously in a
+              background thread; do not do this while anything else is using the
+              camera.
+            - Raises RuntimeError if stop() has already been called."""
+        if self._closed:
+            raise RuntimeError("StreamServer cannot be restarted once stopped!")
+        if self._running:
+            return
+        self._running = True
+        self._microscope.camera.add_frame_listener(self._on_frame)
+        self._threads = [threading.Thread(target=self._server.serve_forever),
+                         threading.Thread(target=self._encode_loop)]
+        if capture:
+            self._capture = True
+            self._threads.append(threading.Thread(target=self._capture_loop))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop serving, disconnect all viewers and close the port."""
+        if self._closed:
+            return
+        self._closed = True
+        if not self._running:
+            self._server.server_close()
+            return
+        self._microscope.camera.remove_frame_listener(self._on_frame)
+        with self._condition:
+            self._running = False
+            self._capture = False
+            self._condition.notify_all()
+        self._server.shutdown()
+        for thread in self._threads:
+            if thread is not threading.current_thread():  # stop() may be called by the capture thread
+                thread.join()
+        self._threads = []
+        self._server.server_close()
+
+    def _on_frame(self, frame):
+        """Camera frame listener: keep a copy of the frame for the encoding thread.
+           Frames arriving faster than max_fps are skipped without being copied."""
+        now = time.time()
+        if now - self._last_copy < self._min_interval and not self._snapshot_pending:
+            return
+        self._last_copy = now
+        with self._condition:
+            self._new_frame = frame.copy()
+            self._condition.notify_all()
+
+    def _capture_loop(self):
+        """Take frames at up to max_fps while there are viewers or a /frame.jpg request
+           is waiting; they reach the server via _on_frame(). If taking a frame fails,
+           the error is printed and the server stopped."""
+        while True:
+            with self._condition:
+                while self._capture and not (self._clients[False] or self._clients[True] or self._snapshot_pending):
+                    self._condition.wait()
+                if not self._capture:
+                    return
+            wait = self._last_copy + self._min_interval - time.time()
+            if wait > 0 and not self._snapshot_pending:
+                time.sleep(wait)
+            try:
+                self._microscope.camera.get_frame(greyscale=False)
+            except Exception as e:
+                print "Stream server stopping, could not take a frame: %s" % e
+                self.stop()
+                return
+
+    def _encode(self, frame, scale=1.0):
+        """JPEG encode a frame, optionally resizing it first."""
+        if scale != 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self._quality])[1].tostring()
+
+    def _encode_loop(self):
+        """Encode the latest frame once for each stream with viewers, then wake the viewers."""
+        last_encode = 0
+        while True:
+            with self._condition:
+                while self._running and self._new_frame is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                frame, self._new_frame = self._new_frame, None
+                clients = dict(self._clients)
+            jpegs = {False: None, True: None}
+            if clients[False] > 0:
+                jpegs[False] = self._encode(frame)
+            if clients[True] > 0:
+                jpegs[True] = self._encode(frame, self._preview_scale)
+            with self._condition:
+                self._latest_frame = frame
+                self._jpegs = jpegs
+                self._frame_number += 1
+                self._frame_time = time.time()
+                self._condition.notify_all()
+            wait = self._min_interval - (time.time() - last_encode)
+            if wait > 0:
+                time.sleep(wait)
+            last_encode = time.time()
+
+    def _add_client(self, preview):
+        with self._condition:
+            self._clients[preview] += 1
+            self._condition.notify_all()  # Wake the capture thread if it is idle
+
+    def _remove_client(self, preview):
+        with self._condition:
+            self._clients[preview] -= 1
+
+    def _wait_for_frame(self, number, preview):
+        """Wait for a frame newer than frame number, returning (number, jpeg).
+           The jpeg is None if the server is stopping."""
+        with self._condition:
+            while self._running and (self._frame_number == number or self._jpegs[preview] is None):
+                self._condition.wait()
+            if not self._running:
+                return (number, None)
+            return (self._frame_number, self._jpegs[preview])
+
+    def snapshot(self):
+        """Return the latest frame as a JPEG, or None if there has not been one.
+           Each frame is encoded at most once, however many times it is requested.
+           If the server is capturing but idle with no viewers, a new frame is taken."""
+        with self._condition:
+            if self._capture and not (self._clients[False] or self._clients[True]):
+                number = self._frame_number
+                deadline = time.time() + self._SNAPSHOT_TIMEOUT
+                self._snapshot_pending = True
+                self._condition.notify_all()
+                while self._running and self._frame_number == number and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                self._snapshot_pending = False
+            if self._jpegs[False] is not None:
+                return self._jpegs[False]
+            frame, number = self._latest_frame, self._frame_number
+        if frame is None:
+            return None
+        with self._snapshot_lock:
+            if self._snapshot[0] != number:
+                self._snapshot = (number, self._encode(frame))
+            return self._snapshot[1]
+
+    def status(self):
+        """Return a dictionary describing the current frame, stage and tracker state."""
+        m = self._microscope
+        status = {"time": time.time(), "frame_number": self._frame_number, "frame_time": self._frame_time,
+                  "viewers": self._clients[False] + self._clients[True], "stage_position": None,
+                  "tracking": m._gui_tracking, "bead_position": None, "selection": None}
+        if m.ready("stage"):  # Don't wait for the stage to start
+            try:
+                status["stage_position"] = [int(p) for p in m.stage._pos]
+            except Exception:  # The stage failed to start
+                pass
+        if m._gui_bead_pos is not None:
+            status["bead_position"] = [float(p) for p in m._gui_bead_pos]
+        if m._gui_sel is not None:
+            status["selection"] = [int(p) for p in m._gui_sel]
+        return status